@@ -1,15 +1,125 @@
 """Purchase Prediction Service - Makes shopping predictions based on analytics."""
 
 import logging
+from dataclasses import dataclass
+from datetime import datetime
 from typing import Optional, List, Dict
-from sqlalchemy import select
+from sqlalchemy import select, func, case, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
-from app.models.product_analytics import ProductAnalytics
+from app.models.product_analytics import (
+    ProductAnalytics,
+    prediction_message,
+    urgency_status,
+)
+from app.models.user_shopping_summary import UserShoppingSummary
 from app.core.database import AsyncSessionLocal
 
 logger = logging.getLogger(__name__)
 
+# Shopping summary buckets: urgency >= URGENT_THRESHOLD is urgent,
+# >= UPCOMING_THRESHOLD is upcoming, anything lower is optional
+URGENT_THRESHOLD = 90
+UPCOMING_THRESHOLD = 70
+
+# Maximum items listed per summary bucket (counts are always complete)
+SUMMARY_BUCKET_LIMIT = 10
+
+
+@dataclass(slots=True)
+class Prediction:
+    """Repurchase prediction for one product.
+    
+    Dates are datetime objects; serialization happens at the API edge.
+    """
+    
+    product_name: str
+    urgency: float
+    confidence: float
+    days_since_last: int
+    avg_interval: int
+    status: str
+    message: str
+    last_purchase: Optional[datetime]
+    estimated_next: Optional[datetime]
+    
+    def to_stored(self) -> Dict:
+        """Convert to the JSON shape kept in UserShoppingSummary."""
+        return {
+            "product_name": self.product_name,
+            "urgency": self.urgency,
+            "confidence": self.confidence,
+            "days_since_last": self.days_since_last,
+            "avg_interval": self.avg_interval,
+            "status": self.status,
+            "message": self.message,
+            "last_purchase": self.last_purchase.isoformat() if self.last_purchase else None,
+            "estimated_next": self.estimated_next.isoformat() if self.estimated_next else None,
+        }
+
+
+# Columns read for ranked predictions, in the order _to_prediction unpacks
+# them; selected directly so read-only endpoints skip ORM instance hydration.
+# Urgency and days since are both evaluated now, so status, message and
+# ranking always agree with each other
+_PREDICTION_COLUMNS = (
+    ProductAnalytics.product_name,
+    ProductAnalytics.current_urgency.label("current_urgency"),
+    ProductAnalytics.repurchase_probability,
+    ProductAnalytics.days_since_last_purchase.label("days_since_last_purchase"),
+    ProductAnalytics.avg_days_between_purchases,
+    ProductAnalytics.last_purchase_date,
+    ProductAnalytics.estimated_next_purchase_date,
+)
+
+
+def _to_prediction(row) -> Prediction:
+    """Build the Prediction returned for a ranked item.
+    
+    The row shape is fixed by _PREDICTION_COLUMNS, so values are unpacked
+    by position instead of looked up by name; extra trailing columns are
+    ignored.
+    """
+    (
+        product_name,
+        urgency,
+        confidence,
+        days_since_last,
+        avg_days,
+        last_purchase,
+        estimated_next,
+        *_
+    ) = row
+    return Prediction(
+        product_name=product_name,
+        urgency=urgency,
+        confidence=confidence,
+        days_since_last=int(days_since_last or 0),
+        avg_interval=int(avg_days or 0),
+        status=urgency_status(urgency),
+        message=prediction_message(product_name, avg_days, days_since_last),
+        last_purchase=last_purchase,
+        estimated_next=estimated_next,
+    )
+
+
+def _format_summary(
+    urgent: List[Dict],
+    upcoming: List[Dict],
+    optional: List[Dict],
+    counts: Dict[str, int]
+) -> Dict:
+    """Build the shopping summary response from bucketed stored predictions."""
+    return {
+        "urgent": urgent,
+        "upcoming": upcoming,
+        "optional": optional,
+        "counts": counts,
+        "total": sum(counts.values()),
+        "summary": f"You need to shop soon! {counts['urgent']} urgent items, {counts['upcoming']} upcoming."
+    }
+
 
 class PurchasePredictionService:
     """Service for generating purchase predictions based on ProductAnalytics.
@@ -27,7 +137,7 @@ class PurchasePredictionService:
         urgency_threshold: float = 0.0,
         limit: int = 10,
         session: Session = None
-    ) -> List[Dict]:
+    ) -> List[Prediction]:
         """Get predicted items ranked by repurchase urgency.
         
         Returns items the user likely needs soon, sorted by urgency score.
@@ -40,7 +150,8 @@ class PurchasePredictionService:
             session: Database session
         
         Returns:
-            List of dicts with item predictions
+            List of Prediction records with datetime fields (unlike
+            get_shopping_summary, whose items are to_stored() dicts)
         """
         if session is None:
             async with AsyncSessionLocal() as session:
@@ -51,32 +162,9 @@ class PurchasePredictionService:
         try:
             logger.info(f"Getting predictions for user {user_id}")
             
-            # Query analytics ordered by urgency
-            stmt = select(ProductAnalytics).where(
-                ProductAnalytics.user_id == user_id,
-                ProductAnalytics.repurchase_urgency >= urgency_threshold,
-                ProductAnalytics.repurchase_probability > 0  # Only items with purchase history
-            ).order_by(
-                ProductAnalytics.repurchase_urgency.desc()
-            ).limit(limit)
-            
-            result = await session.execute(stmt)
-            analytics_list = result.scalars().all()
-            
-            predictions = []
-            for analytics in analytics_list:
-                prediction = {
-                    "product_name": analytics.product_name,
-                    "urgency": analytics.repurchase_urgency,
-                    "confidence": analytics.repurchase_probability,
-                    "days_since_last": int(analytics.days_since_last_purchase or 0),
-                    "avg_interval": int(analytics.avg_days_between_purchases or 0),
-                    "status": analytics.get_urgency_status(),
-                    "message": analytics.get_prediction_message(),
-                    "last_purchase": analytics.last_purchase_date.isoformat() if analytics.last_purchase_date else None,
-                    "estimated_next": analytics.estimated_next_purchase_date.isoformat() if analytics.estimated_next_purchase_date else None,
-                }
-                predictions.append(prediction)
+            predictions = await PurchasePredictionService._fetch_predictions(
+                user_id, session, limit, min_urgency=urgency_threshold
+            )
             
             logger.info(f"Found {len(predictions)} predictions")
             return predictions
@@ -85,6 +173,27 @@ class PurchasePredictionService:
             logger.error(f"Error getting predictions: {e}")
             return []
     
+    @staticmethod
+    async def _fetch_predictions(
+        user_id: int,
+        session: Session,
+        limit: int,
+        min_urgency: float = 0.0
+    ) -> List[Prediction]:
+        """Query predictions with urgency >= min_urgency, ranked by urgency."""
+        stmt = select(*_PREDICTION_COLUMNS).where(
+            ProductAnalytics.user_id == user_id,
+            ProductAnalytics.current_urgency >= min_urgency,
+            # Only items with purchase history; inline literal so prepared
+            # (generic) plans can still match the partial idx_pa_predict
+            ProductAnalytics.repurchase_probability > literal_column("0")
+        ).order_by(
+            ProductAnalytics.current_urgency.desc()
+        ).limit(limit)
+        
+        result = await session.execute(stmt)
+        return [_to_prediction(row) for row in result.all()]
+    
     @staticmethod
     async def get_shopping_summary(
         user_id: int,
@@ -92,8 +201,15 @@ class PurchasePredictionService:
     ) -> Dict:
         """Get grouped shopping summary (urgent/upcoming/optional).
         
+        Reads the precomputed UserShoppingSummary row and only rebuilds it
+        when it is missing, was built on an earlier day, or is older than
+        the user's latest analytics.
+        Each list holds at most SUMMARY_BUCKET_LIMIT items ranked by
+        urgency; 'counts' and 'total' cover every tracked product.
+        
         Returns:
-            Dict with 'urgent', 'upcoming', 'optional' lists
+            Dict with 'urgent', 'upcoming', 'optional' lists of stored
+            prediction dicts (Prediction.to_stored(), dates as ISO strings)
         """
         if session is None:
             async with AsyncSessionLocal() as session:
@@ -104,27 +220,134 @@ class PurchasePredictionService:
         try:
             logger.info(f"Getting shopping summary for user {user_id}")
             
-            # Get all predictions
-            predictions = await PurchasePredictionService.get_predicted_purchases(
-                user_id, 0.0, 999, session
+            # Fetch the stored summary together with the latest analysis time
+            latest_analysis = select(
+                func.max(ProductAnalytics.last_analyzed_at)
+            ).where(
+                ProductAnalytics.user_id == user_id
+            ).scalar_subquery()
+            stmt = select(
+                UserShoppingSummary,
+                latest_analysis.label("last_analyzed_at")
+            ).where(UserShoppingSummary.user_id == user_id)
+            
+            result = await session.execute(stmt)
+            row = result.first()
+            summary = row.UserShoppingSummary if row else None
+            # days_since_last and message are day-granular, so a summary
+            # built on an earlier day is stale even without new analytics
+            is_stale = summary is None or (
+                summary.updated_at.date() < datetime.utcnow().date()
+            ) or (
+                row.last_analyzed_at is not None
+                and summary.updated_at < row.last_analyzed_at
             )
             
-            # Categorize by urgency
-            urgent = [p for p in predictions if p["urgency"] >= 90]
-            upcoming = [p for p in predictions if 70 <= p["urgency"] < 90]
-            optional = [p for p in predictions if p["urgency"] < 70]
+            if not is_stale:
+                return _format_summary(
+                    summary.urgent_items,
+                    summary.upcoming_items,
+                    summary.optional_items,
+                    summary.bucket_counts
+                )
             
-            return {
-                "urgent": urgent,
-                "upcoming": upcoming,
-                "optional": optional,
-                "total": len(predictions),
-                "summary": f"You need to shop soon! {len(urgent)} urgent items, {len(upcoming)} upcoming."
-            }
+            await PurchasePredictionService.lock_user_summary(user_id, session)
+            summary = await PurchasePredictionService.refresh_shopping_summary(
+                user_id, session
+            )
+            await session.commit()
+            return summary
             
         except Exception as e:
             logger.error(f"Error getting shopping summary: {e}")
-            return {"urgent": [], "upcoming": [], "optional": [], "total": 0}
+            await session.rollback()
+            return {
+                "urgent": [],
+                "upcoming": [],
+                "optional": [],
+                "counts": {"urgent": 0, "upcoming": 0, "optional": 0},
+                "total": 0
+            }
+    
+    @staticmethod
+    async def lock_user_summary(user_id: int, session: Session) -> None:
+        """Serialize summary rebuilds for one user until the transaction ends.
+        
+        Everything that rebuilds the summary takes this lock before reading
+        analytics, so each rebuild sees every analytics write committed
+        before it. Without it, two overlapping receipts can each rebuild
+        from a snapshot missing the other's products, and the later,
+        incomplete summary still passes the staleness check.
+        """
+        await session.execute(select(func.pg_advisory_xact_lock(user_id)))
+    
+    @staticmethod
+    async def refresh_shopping_summary(
+        user_id: int,
+        session: Session
+    ) -> Dict:
+        """Rebuild and store the user's shopping summary.
+        
+        Bucketing, ranking and counting run in a single windowed query.
+        Items are returned in the same JSON shape that is stored (dates as
+        ISO strings), so cached and rebuilt summaries look identical and
+        reads never re-parse them. The caller owns the transaction and must
+        hold lock_user_summary for this user; this
+        method does not commit.
+        
+        Returns:
+            The rebuilt summary dict
+        """
+        bucket = case(
+            (ProductAnalytics.current_urgency >= URGENT_THRESHOLD, "urgent"),
+            (ProductAnalytics.current_urgency >= UPCOMING_THRESHOLD, "upcoming"),
+            else_="optional"
+        )
+        ranked = select(
+            *_PREDICTION_COLUMNS,
+            bucket.label("bucket"),
+            func.row_number().over(
+                partition_by=bucket,
+                order_by=ProductAnalytics.current_urgency.desc()
+            ).label("bucket_rank"),
+            func.count().over(partition_by=bucket).label("bucket_count")
+        ).where(
+            ProductAnalytics.user_id == user_id,
+            ProductAnalytics.current_urgency >= 0.0,
+            ProductAnalytics.repurchase_probability > literal_column("0")
+        ).subquery("ranked")
+        
+        stmt = select(ranked).where(
+            ranked.c.bucket_rank <= SUMMARY_BUCKET_LIMIT
+        ).order_by(ranked.c.current_urgency.desc())
+        
+        result = await session.execute(stmt)
+        buckets = {"urgent": [], "upcoming": [], "optional": []}
+        counts = {"urgent": 0, "upcoming": 0, "optional": 0}
+        for row in result.all():
+            buckets[row.bucket].append(_to_prediction(row).to_stored())
+            counts[row.bucket] = row.bucket_count
+        
+        stmt_upsert = pg_insert(UserShoppingSummary).values(
+            user_id=user_id,
+            urgent_items=buckets["urgent"],
+            upcoming_items=buckets["upcoming"],
+            optional_items=buckets["optional"],
+            bucket_counts=counts,
+            updated_at=datetime.utcnow()
+        )
+        stmt_upsert = stmt_upsert.on_conflict_do_update(
+            index_elements=["user_id"],
+            set_={
+                key: stmt_upsert.excluded[key]
+                for key in ("urgent_items", "upcoming_items", "optional_items", "bucket_counts", "updated_at")
+            }
+        )
+        await session.execute(stmt_upsert)
+        
+        return _format_summary(
+            buckets["urgent"], buckets["upcoming"], buckets["optional"], counts
+        )
     
     @staticmethod
     async def get_item_prediction(
@@ -159,15 +382,15 @@ class PurchasePredictionService:
             return {
                 "product_name": analytics.product_name,
                 "total_purchases": analytics.total_purchases,
-                "last_purchase_date": analytics.last_purchase_date.isoformat() if analytics.last_purchase_date else None,
+                "last_purchase_date": analytics.last_purchase_date,
                 "avg_interval_days": analytics.avg_days_between_purchases,
                 "days_since_last": analytics.days_since_last_purchase,
                 "min_interval": analytics.min_days_interval,
                 "max_interval": analytics.max_days_interval,
-                "urgency_score": analytics.repurchase_urgency,
+                "urgency_score": analytics.current_urgency,
                 "confidence": analytics.repurchase_probability,
                 "is_seasonal": analytics.is_seasonal,
-                "next_purchase_estimate": analytics.estimated_next_purchase_date.isoformat() if analytics.estimated_next_purchase_date else None,
+                "next_purchase_estimate": analytics.estimated_next_purchase_date,
                 "status": analytics.get_urgency_status(),
                 "recommendation": analytics.get_prediction_message(),
             }
@@ -3,15 +3,217 @@
 import logging
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
-from sqlalchemy import select, func
+from sqlalchemy import select, delete, exists, func, case, cast, any_, bindparam, false, literal, literal_column, DateTime, Float, Integer, String
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from app.models.purchase_record import PurchaseRecord
-from app.models.product_analytics import ProductAnalytics
+from app.models.product_analytics import ProductAnalytics, days_since
+from app.services.purchase_prediction_service import PurchasePredictionService
 from app.core.database import AsyncSessionLocal
 
 logger = logging.getLogger(__name__)
 
+# ProductAnalytics columns rewritten when an existing row is upserted
+_UPDATABLE_FIELDS = (
+    "total_purchases",
+    "last_purchase_date",
+    "avg_days_between_purchases",
+    "min_days_interval",
+    "max_days_interval",
+    "repurchase_urgency",
+    "repurchase_probability",
+    "estimated_next_purchase_date",
+    "last_analyzed_at",
+    "updated_at",
+)
+
+
+def _purchase_stats_query(user_id: int, product_names: Optional[List[str]] = None):
+    """Build the per-product purchase statistics aggregation.
+    
+    Covers the given products, or every product the user bought when
+    product_names is None.
+    
+    Returns one row per product with its purchase count, first/last
+    purchase dates, min/max interval, days since the last purchase and the
+    user's total distinct purchase dates (the probability denominator).
+    Intervals come from a LAG window over each product's ordered dates.
+    """
+    conditions = [PurchaseRecord.user_id == user_id]
+    if product_names is not None:
+        # ANY(array) keeps the SQL text (and prepared statement) identical
+        # for any number of products, unlike an expanding IN list
+        conditions.append(PurchaseRecord.item_name == any_(
+            bindparam("product_names", product_names, type_=ARRAY(String))
+        ))
+    
+    purchase_gaps = select(
+        PurchaseRecord.item_name,
+        PurchaseRecord.purchase_date,
+        (
+            PurchaseRecord.purchase_date
+            - func.lag(PurchaseRecord.purchase_date).over(
+                partition_by=PurchaseRecord.item_name,
+                order_by=PurchaseRecord.purchase_date
+            )
+        ).label("gap")
+    ).where(*conditions).cte("purchase_gaps")
+    gap_days = func.extract("day", purchase_gaps.c.gap)
+    total_purchase_dates = select(
+        func.count(func.distinct(PurchaseRecord.purchase_date))
+    ).where(PurchaseRecord.user_id == user_id).scalar_subquery()
+    
+    return select(
+        purchase_gaps.c.item_name,
+        func.count().label("total_purchases"),
+        func.min(purchase_gaps.c.purchase_date).label("first_purchase_date"),
+        func.max(purchase_gaps.c.purchase_date).label("last_purchase_date"),
+        func.min(gap_days).label("min_interval"),
+        func.max(gap_days).label("max_interval"),
+        days_since(func.max(purchase_gaps.c.purchase_date)).label("days_since_last"),
+        total_purchase_dates.label("total_purchase_dates")
+    ).group_by(purchase_gaps.c.item_name)
+
+
+def _analytics_fields(user_id: int, stats, analyzed_at: datetime) -> Dict:
+    """Calculate ProductAnalytics fields from one product's statistics row."""
+    total_purchases = stats.total_purchases
+    last_purchase_date = stats.last_purchase_date
+    first_purchase_date = stats.first_purchase_date
+    
+    # Calculate average days between purchases
+    if total_purchases > 1:
+        days_diff = (last_purchase_date - first_purchase_date).days
+        avg_days = days_diff / (total_purchases - 1)
+    else:
+        avg_days = None
+    
+    # Calculate urgency score (days_since_last / avg_days) * 100
+    if avg_days and avg_days > 0:
+        urgency_score = (stats.days_since_last / avg_days) * 100
+    else:
+        urgency_score = 0.0
+    
+    # Calculate repurchase probability
+    # (times bought in receipts / total distinct receipt dates)
+    repurchase_probability = (total_purchases / (stats.total_purchase_dates or 1)) * 100
+    
+    # Estimate next purchase date
+    if avg_days:
+        estimated_next = last_purchase_date + timedelta(days=avg_days)
+    else:
+        estimated_next = None
+    
+    return {
+        "user_id": user_id,
+        "product_name": stats.item_name,
+        "total_purchases": total_purchases,
+        "last_purchase_date": last_purchase_date,
+        "avg_days_between_purchases": avg_days,
+        "min_days_interval": float(stats.min_interval) if stats.min_interval else None,
+        "max_days_interval": float(stats.max_interval) if stats.max_interval else None,
+        "repurchase_urgency": urgency_score,
+        "repurchase_probability": repurchase_probability,
+        "estimated_next_purchase_date": estimated_next,
+        "last_analyzed_at": analyzed_at,
+        "updated_at": analyzed_at,
+    }
+
+
+# Per-product values bound as arrays by _upsert_analytics_statement
+_UPSERT_ARRAY_COLUMNS = {
+    "product_name": String,
+    "total_purchases": Integer,
+    "last_purchase_date": DateTime,
+    "avg_days_between_purchases": Float,
+    "min_days_interval": Float,
+    "max_days_interval": Float,
+    "repurchase_urgency": Float,
+    "repurchase_probability": Float,
+    "estimated_next_purchase_date": DateTime,
+}
+
+
+def _upsert_analytics_statement(user_id: int, rows: List[Dict], analyzed_at: datetime):
+    """Build the multi-product ProductAnalytics upsert.
+    
+    Each field is bound as one array and expanded with unnest(), so the
+    SQL text (and prepared statement) is the same for any number of rows,
+    unlike a multi-row VALUES list.
+    """
+    product_rows = func.unnest(*(
+        bindparam(name, [fields[name] for fields in rows], type_=ARRAY(column_type))
+        for name, column_type in _UPSERT_ARRAY_COLUMNS.items()
+    )).table_valued(*_UPSERT_ARRAY_COLUMNS).render_derived("product_rows")
+    
+    columns = {
+        "user_id": literal(user_id),
+        **{name: product_rows.c[name] for name in _UPSERT_ARRAY_COLUMNS},
+        "is_seasonal": false(),
+        "created_at": literal(analyzed_at, DateTime),
+        "updated_at": literal(analyzed_at, DateTime),
+        "last_analyzed_at": literal(analyzed_at, DateTime),
+    }
+    
+    stmt = pg_insert(ProductAnalytics).from_select(
+        list(columns),
+        select(*(expression.label(name) for name, expression in columns.items()))
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=["user_id", "product_name"],
+        set_={key: stmt.excluded[key] for key in _UPDATABLE_FIELDS}
+    )
+
+
+def _rebuild_analytics_statement(user_id: int, analyzed_at: datetime):
+    """Build the INSERT ... SELECT upsert recomputing all of a user's analytics.
+    
+    Mirrors _analytics_fields in SQL so no rows pass through Python.
+    """
+    stats = _purchase_stats_query(user_id).subquery("stats")
+    
+    avg_days = case((
+        stats.c.total_purchases > 1,
+        cast(func.extract("day", stats.c.last_purchase_date - stats.c.first_purchase_date), Float)
+        / (stats.c.total_purchases - 1)
+    ))
+    columns = {
+        "user_id": literal(user_id),
+        "product_name": stats.c.item_name,
+        "total_purchases": stats.c.total_purchases,
+        "last_purchase_date": stats.c.last_purchase_date,
+        "avg_days_between_purchases": avg_days,
+        "min_days_interval": cast(func.nullif(stats.c.min_interval, 0), Float),
+        "max_days_interval": cast(func.nullif(stats.c.max_interval, 0), Float),
+        "repurchase_urgency": case(
+            (avg_days > 0, stats.c.days_since_last / avg_days * 100),
+            else_=0.0
+        ),
+        "repurchase_probability": (
+            stats.c.total_purchases * 100.0
+            / func.coalesce(func.nullif(stats.c.total_purchase_dates, 0), 1)
+        ),
+        "estimated_next_purchase_date": case((
+            avg_days > 0,
+            stats.c.last_purchase_date + literal_column("INTERVAL '1 day'") * avg_days
+        )),
+        "is_seasonal": false(),
+        "created_at": literal(analyzed_at, DateTime),
+        "updated_at": literal(analyzed_at, DateTime),
+        "last_analyzed_at": literal(analyzed_at, DateTime),
+    }
+    
+    stmt = pg_insert(ProductAnalytics).from_select(
+        list(columns),
+        select(*(expression.label(name) for name, expression in columns.items()))
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=["user_id", "product_name"],
+        set_={key: stmt.excluded[key] for key in _UPDATABLE_FIELDS}
+    )
+
 
 class PurchaseAnalyticsService:
     """Service for calculating purchase analytics and patterns.
@@ -41,105 +243,157 @@ class PurchaseAnalyticsService:
                     user_id, product_name, session
                 )
         
+        logger.info(f"Updating analytics for user {user_id}, product: {product_name}")
+        analytics_list = await PurchaseAnalyticsService.update_analytics_bulk(
+            user_id, [product_name], session
+        )
+        
+        return analytics_list[0] if analytics_list else None
+    
+    @staticmethod
+    async def update_analytics_bulk(
+        user_id: int,
+        product_names: List[str],
+        session: Session = None
+    ) -> List[ProductAnalytics]:
+        """Update analytics for several products in one transaction.
+        
+        Used when a receipt adds many items at once: statistics for every
+        product, including the probability denominator, come from one
+        aggregated query and are written with a single multi-row upsert
+        and commit.
+        """
+        if session is None:
+            async with AsyncSessionLocal() as session:
+                return await PurchaseAnalyticsService.update_analytics_bulk(
+                    user_id, product_names, session
+                )
+        
         try:
-            logger.info(f"Updating analytics for user {user_id}, product: {product_name}")
+            logger.info(f"Updating analytics for user {user_id}, {len(product_names)} products")
             
-            # Get all purchases for this product
-            stmt = select(PurchaseRecord).where(
-                PurchaseRecord.user_id == user_id,
-                PurchaseRecord.item_name == product_name
-            ).order_by(PurchaseRecord.purchase_date.asc())
+            # Serialize with other analytics writers for this user so the
+            # summary refreshed below includes their committed products
+            await PurchasePredictionService.lock_user_summary(user_id, session)
             
-            result = await session.execute(stmt)
-            purchases = result.scalars().all()
-            
-            if not purchases:
-                logger.warning(f"No purchases found for {product_name}")
-                return None
-            
-            # Calculate metrics
-            total_purchases = len(purchases)
-            last_purchase_date = purchases[-1].purchase_date
-            first_purchase_date = purchases[0].purchase_date
-            
-            # Calculate average days between purchases
-            if total_purchases > 1:
-                days_diff = (last_purchase_date - first_purchase_date).days
-                avg_days = days_diff / (total_purchases - 1)
-            else:
-                avg_days = None
-            
-            # Calculate days since last purchase
-            days_since_last = (datetime.utcnow() - last_purchase_date).days
-            
-            # Calculate purchase intervals
-            intervals = []
-            for i in range(1, len(purchases)):
-                interval = (purchases[i].purchase_date - purchases[i-1].purchase_date).days
-                intervals.append(interval)
-            
-            min_interval = min(intervals) if intervals else None
-            max_interval = max(intervals) if intervals else None
-            
-            # Calculate urgency score (days_since_last / avg_days) * 100
-            if avg_days and avg_days > 0:
-                urgency_score = (days_since_last / avg_days) * 100
-            else:
-                urgency_score = 0.0
-            
-            # Calculate repurchase probability
-            # (times bought in receipts / total distinct receipt dates)
-            stmt_all_purchases = select(func.count(func.distinct(
-                PurchaseRecord.purchase_date
-            ))).where(PurchaseRecord.user_id == user_id)
-            
-            result_all = await session.execute(stmt_all_purchases)
-            total_purchase_dates = result_all.scalar() or 1
-            
-            repurchase_probability = (total_purchases / total_purchase_dates) * 100
-            
-            # Estimate next purchase date
-            if avg_days:
-                estimated_next = last_purchase_date + timedelta(days=avg_days)
-            else:
-                estimated_next = None
-            
-            # Get or create ProductAnalytics record
-            stmt_analytics = select(ProductAnalytics).where(
-                ProductAnalytics.user_id == user_id,
-                ProductAnalytics.product_name == product_name
+            result = await session.execute(
+                _purchase_stats_query(user_id, product_names)
             )
-            result_analytics = await session.execute(stmt_analytics)
-            analytics = result_analytics.scalars().first()
+            stats_rows = result.all()
+            
+            if not stats_rows:
+                logger.warning(f"No purchases found for {product_names}")
+                # End the transaction so the summary lock is released
+                await session.commit()
+                return []
+            
+            analyzed_at = datetime.utcnow()
+            rows = [
+                _analytics_fields(user_id, stats, analyzed_at)
+                for stats in stats_rows
+            ]
+            for fields in rows:
+                logger.info(f"Analytics for {fields['product_name']}: urgency={fields['repurchase_urgency']:.1f}%, probability={fields['repurchase_probability']:.1f}%")
             
-            if not analytics:
-                analytics = ProductAnalytics(
-                    user_id=user_id,
-                    product_name=product_name
+            # Upsert all ProductAnalytics records in a single statement
+            stmt_upsert = _upsert_analytics_statement(
+                user_id, rows, analyzed_at
+            ).returning(ProductAnalytics)
+            
+            result_analytics = await session.execute(
+                stmt_upsert,
+                execution_options={"populate_existing": True}
+            )
+            analytics_list = result_analytics.scalars().all()
+            
+            # RETURNING leaves query-time columns unloaded; fill in the values
+            # already computed above instead of lazy-loading them
+            days_since_last = {stats.item_name: stats.days_since_last for stats in stats_rows}
+            urgency = {fields["product_name"]: fields["repurchase_urgency"] for fields in rows}
+            for analytics in analytics_list:
+                set_committed_value(
+                    analytics,
+                    "days_since_last_purchase",
+                    days_since_last[analytics.product_name]
+                )
+                set_committed_value(
+                    analytics,
+                    "current_urgency",
+                    urgency[analytics.product_name]
                 )
-                session.add(analytics)
-            
-            # Update analytics record
-            analytics.total_purchases = total_purchases
-            analytics.last_purchase_date = last_purchase_date
-            analytics.avg_days_between_purchases = avg_days
-            analytics.days_since_last_purchase = float(days_since_last)
-            analytics.min_days_interval = float(min_interval) if min_interval else None
-            analytics.max_days_interval = float(max_interval) if max_interval else None
-            analytics.repurchase_urgency = urgency_score
-            analytics.repurchase_probability = repurchase_probability
-            analytics.estimated_next_purchase_date = estimated_next
-            analytics.last_analyzed_at = datetime.utcnow()
+            
+            # Keep the stored shopping summary in step with the analytics
+            await PurchasePredictionService.refresh_shopping_summary(
+                user_id, session
+            )
             
             await session.commit()
-            logger.info(f"Analytics updated: urgency={urgency_score:.1f}%, probability={repurchase_probability:.1f}%")
+            logger.info(f"Analytics updated for {len(analytics_list)} products")
             
-            return analytics
+            return analytics_list
             
         except Exception as e:
             logger.error(f"Error updating analytics: {e}")
             await session.rollback()
-            return None
+            return []
+    
+    @staticmethod
+    async def rebuild_user_analytics(
+        user_id: int,
+        session: Session = None
+    ) -> int:
+        """Recompute analytics for every product a user has bought.
+        
+        Runs as a single INSERT ... SELECT ... ON CONFLICT DO UPDATE over
+        purchase_records, so the whole rebuild is one statement regardless
+        of how many products the user has. ProductAnalytics rows for
+        products that no longer have any purchase records are deleted in
+        the same transaction.
+        
+        Returns:
+            Number of ProductAnalytics rows written
+        """
+        if session is None:
+            async with AsyncSessionLocal() as session:
+                return await PurchaseAnalyticsService.rebuild_user_analytics(
+                    user_id, session
+                )
+        
+        try:
+            logger.info(f"Rebuilding all analytics for user {user_id}")
+            
+            await PurchasePredictionService.lock_user_summary(user_id, session)
+            
+            # Stamp with the app clock, like update_analytics_bulk, so the
+            # summary staleness check compares timestamps from one clock
+            result = await session.execute(
+                _rebuild_analytics_statement(user_id, datetime.utcnow())
+            )
+            
+            # Drop analytics whose purchase history is gone
+            stmt_orphans = delete(ProductAnalytics).where(
+                ProductAnalytics.user_id == user_id,
+                ~exists().where(
+                    PurchaseRecord.user_id == user_id,
+                    PurchaseRecord.item_name == ProductAnalytics.product_name
+                )
+            )
+            await session.execute(stmt_orphans)
+            
+            # Keep the stored shopping summary in step with the analytics
+            await PurchasePredictionService.refresh_shopping_summary(
+                user_id, session
+            )
+            
+            await session.commit()
+            logger.info(f"Analytics rebuilt for {result.rowcount} products")
+            
+            return result.rowcount
+            
+        except Exception as e:
+            logger.error(f"Error rebuilding analytics: {e}")
+            await session.rollback()
+            return 0
     
     @staticmethod
     async def get_user_analytics(
@@ -157,8 +411,8 @@ class PurchaseAnalyticsService:
         try:
             stmt = select(ProductAnalytics).where(
                 ProductAnalytics.user_id == user_id,
-                ProductAnalytics.repurchase_urgency >= urgency_threshold
-            ).order_by(ProductAnalytics.repurchase_urgency.desc())
+                ProductAnalytics.current_urgency >= urgency_threshold
+            ).order_by(ProductAnalytics.current_urgency.desc())
             
             result = await session.execute(stmt)
             return result.scalars().all()
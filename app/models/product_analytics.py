@@ -1,12 +1,60 @@
 """Product Analytics Model - Stores calculated metrics for purchases."""
 
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, JSON, UniqueConstraint, Index
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, JSON, UniqueConstraint, Index, case, cast, func, text
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import relationship, column_property
 from datetime import datetime
-import uuid
+from functools import lru_cache
+from typing import Optional
+import bisect
 
 from app.core.database import Base
 
+# Urgency status bands: each threshold reached moves one label up
+_URGENCY_THRESHOLDS = (50, 70, 85, 100)
+_URGENCY_LABELS = ("⚪ OPTIONAL", "🟢 UPCOMING", "🟡 SOON", "🟠 URGENT", "🔴 OVERDUE")
+
+
+def days_since(timestamp):
+    """SQL expression for whole days elapsed since a naive UTC timestamp."""
+    return cast(func.extract("day", func.timezone("UTC", func.now()) - timestamp), Float)
+
+
+def urgency_score(last_purchase_date, avg_days_between_purchases):
+    """SQL expression for the urgency score as of now.
+    
+    (days since last purchase / average interval) * 100, or 0 when there
+    is no interval yet; the same formula analytics updates store.
+    """
+    return case(
+        (
+            avg_days_between_purchases > 0,
+            days_since(last_purchase_date) / avg_days_between_purchases * 100
+        ),
+        else_=0.0
+    )
+
+
+def urgency_status(urgency: float) -> str:
+    """Return human-readable status for an urgency score."""
+    return _URGENCY_LABELS[bisect.bisect_right(_URGENCY_THRESHOLDS, urgency)]
+
+
+@lru_cache(maxsize=10_000)
+def prediction_message(
+    product_name: str,
+    avg_days_between_purchases: Optional[float],
+    days_since_last_purchase: Optional[float]
+) -> str:
+    """Generate human-readable prediction message from raw metrics.
+    
+    Cached on its arguments: the key changes whenever the analytics do,
+    so repeat requests for unchanged products skip the formatting.
+    """
+    if avg_days_between_purchases and days_since_last_purchase:
+        return f"You usually buy {product_name} every {avg_days_between_purchases:.0f} days. Last purchase: {days_since_last_purchase:.0f} days ago."
+    return f"Not enough data for {product_name} predictions yet."
+
 
 class ProductAnalytics(Base):
     """Model for storing calculated purchase analytics per product per user.
@@ -20,16 +68,31 @@ class ProductAnalytics(Base):
         UniqueConstraint("user_id", "product_name", name="uq_user_product"),
         Index("idx_pa_user_product", "user_id", "product_name"),
         Index("idx_pa_urgency", "user_id", "repurchase_urgency"),
+        # Covering index for the prediction queries: index-only scans over
+        # a user's rows with purchase history. Urgency is computed from the
+        # included columns at query time, so ranking sorts in memory
+        Index(
+            "idx_pa_predict",
+            "user_id",
+            postgresql_include=[
+                "repurchase_probability",
+                "product_name",
+                "avg_days_between_purchases",
+                "last_purchase_date",
+                "estimated_next_purchase_date",
+            ],
+            postgresql_where=text("repurchase_probability > 0"),
+        ),
     )
     
     # Primary Key
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     
     # Foreign Keys
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     
     # Product Identity
-    product_name = Column(String(255), nullable=False, index=True)
+    product_name = Column(String(255), nullable=False)
     
     # Purchase Statistics
     total_purchases = Column(Integer, default=0)  # Lifetime purchase count
@@ -37,13 +100,14 @@ class ProductAnalytics(Base):
     
     # Frequency Metrics
     avg_days_between_purchases = Column(Float, nullable=True)  # Average interval
-    days_since_last_purchase = Column(Float, nullable=True)  # Dynamic calculation
+    days_since_last_purchase = column_property(days_since(last_purchase_date))  # Evaluated at query time
     min_days_interval = Column(Float, nullable=True)  # Shortest gap seen
     max_days_interval = Column(Float, nullable=True)  # Longest gap seen
     
     # Prediction Scores (0-100 scale)
-    repurchase_urgency = Column(Float, default=0.0)  # 0-100+ (over 100% = overdue)
+    repurchase_urgency = Column(Float, default=0.0)  # 0-100+ as of last_analyzed_at (over 100% = overdue)
     repurchase_probability = Column(Float, default=0.0)  # 0-100 confidence
+    current_urgency = column_property(urgency_score(last_purchase_date, avg_days_between_purchases))  # repurchase_urgency as of now
     
     # Pattern Detection
     purchase_frequency_pattern = Column(JSON, nullable=True)  # {"Mon": 0.1, "Fri": 0.9}
@@ -74,7 +138,7 @@ class ProductAnalytics(Base):
     def to_dict(self) -> dict:
         """Convert to dictionary for API responses."""
         return {
-            "id": self.id,
+            "id": str(self.id) if self.id else None,
             "user_id": self.user_id,
             "product_name": self.product_name,
             "total_purchases": self.total_purchases,
@@ -83,7 +147,7 @@ class ProductAnalytics(Base):
             "days_since_last_purchase": self.days_since_last_purchase,
             "min_days_interval": self.min_days_interval,
             "max_days_interval": self.max_days_interval,
-            "repurchase_urgency": self.repurchase_urgency,
+            "repurchase_urgency": self.current_urgency,
             "repurchase_probability": self.repurchase_probability,
             "purchase_frequency_pattern": self.purchase_frequency_pattern,
             "is_seasonal": self.is_seasonal,
@@ -94,19 +158,12 @@ class ProductAnalytics(Base):
     
     def get_urgency_status(self) -> str:
         """Return human-readable urgency status."""
-        if self.repurchase_urgency >= 100:
-            return "🔴 OVERDUE"
-        elif self.repurchase_urgency >= 85:
-            return "🟠 URGENT"
-        elif self.repurchase_urgency >= 70:
-            return "🟡 SOON"
-        elif self.repurchase_urgency >= 50:
-            return "🟢 UPCOMING"
-        else:
-            return "⚪ OPTIONAL"
+        return urgency_status(self.current_urgency)
     
     def get_prediction_message(self) -> str:
         """Generate human-readable prediction message."""
-        if self.avg_days_between_purchases and self.days_since_last_purchase:
-            return f"You usually buy {self.product_name} every {self.avg_days_between_purchases:.0f} days. Last purchase: {self.days_since_last_purchase:.0f} days ago."
-        return f"Not enough data for {self.product_name} predictions yet."
+        return prediction_message(
+            self.product_name,
+            self.avg_days_between_purchases,
+            self.days_since_last_purchase
+        )
@@ -1,9 +1,9 @@
 """Purchase Record Model - Stores individual purchase transactions."""
 
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Text, Index
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Text, Index, text
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from datetime import datetime
-import uuid
 
 from app.core.database import Base
 
@@ -22,14 +22,14 @@ class PurchaseRecord(Base):
     )
     
     # Primary Key
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     
     # Foreign Keys
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
-    receipt_id = Column(String(36), ForeignKey("receipts.id"), nullable=True)
+    receipt_id = Column(UUID(as_uuid=True), ForeignKey("receipts.id"), nullable=True)
     
     # Item Details
-    item_name = Column(String(255), nullable=False, index=True)
+    item_name = Column(String(255), nullable=False)
     category = Column(String(100), nullable=True)  # "Dairy", "Vegetables", etc.
     
     # Quantity Information
@@ -41,7 +41,7 @@ class PurchaseRecord(Base):
     currency = Column(String(3), default="BRL")  # Brazilian Real
     
     # CRITICAL: Purchase date for pattern analysis
-    purchase_date = Column(DateTime, nullable=False, index=True, default=datetime.utcnow)
+    purchase_date = Column(DateTime, nullable=False, default=datetime.utcnow)
     
     # Source tracking
     source = Column(String(20), nullable=False, default="manual")  # "receipt" or "manual"
@@ -69,7 +69,7 @@ class PurchaseRecord(Base):
     def to_dict(self) -> dict:
         """Convert to dictionary for API responses."""
         return {
-            "id": self.id,
+            "id": str(self.id) if self.id else None,
             "user_id": self.user_id,
             "item_name": self.item_name,
             "category": self.category,
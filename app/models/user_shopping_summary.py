@@ -0,0 +1,40 @@
+"""User Shopping Summary Model - Stores the precomputed shopping summary."""
+
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, JSON
+from datetime import datetime
+
+from app.core.database import Base
+
+
+class UserShoppingSummary(Base):
+    """Model for storing each user's urgent/upcoming/optional summary.
+
+    Acts as a materialized view over ProductAnalytics: it is rebuilt inside
+    the same transaction whenever analytics are updated, so the summary
+    endpoint reads one row instead of ranking products on every request.
+    A summary older than the user's latest ProductAnalytics.last_analyzed_at,
+    or built on an earlier day, is stale and gets rebuilt on read.
+    """
+
+    __tablename__ = "user_shopping_summary"
+
+    # Primary Key (one summary per user)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+
+    # Bucketed predictions, each capped at SUMMARY_BUCKET_LIMIT items
+    urgent_items = Column(JSON, nullable=False, default=list)
+    upcoming_items = Column(JSON, nullable=False, default=list)
+    optional_items = Column(JSON, nullable=False, default=list)
+
+    # Full bucket sizes: {"urgent": 2, "upcoming": 5, "optional": 12}
+    bucket_counts = Column(JSON, nullable=False, default=dict)
+
+    # Metadata
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"""<UserShoppingSummary(
+            user_id={self.user_id},
+            counts={self.bucket_counts},
+            updated_at={self.updated_at}
+        )>"""